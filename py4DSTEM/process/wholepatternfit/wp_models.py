@@ -1,6 +1,85 @@
 from typing import Optional
 from enum import Flag, auto
+import functools
 import numpy as np
+from scipy.special import expit
+
+try:
+    import numba as nb
+except ImportError:
+    nb = None
+
+try:
+    import cupy as cp
+    from cupyx.scipy.special import expit as cp_expit
+except (ImportError, ModuleNotFoundError):
+    cp = None
+
+# Upper bound on the number of elements in the per-block peak stacks.
+# Blocks much larger than the CPU cache are slower than a loop over peaks.
+_MAX_BLOCK_ELEMENTS = 2**18
+
+# Side length of the pattern tiles the Numba lattice kernel works on,
+# small enough that a tile of DP stays in the L2 cache.
+_TILE_SIZE = 64
+
+
+def _get_array_module(array):
+    """
+    Return cupy if array lives on the GPU, and numpy otherwise. The models
+    use it to pick the device from the pattern or Jacobian they write into.
+    """
+    if isinstance(array, _JacobianColumns):
+        array = array.array
+    if cp is not None:
+        return cp.get_array_module(array)
+    return np
+
+
+class _JacobianColumns:
+    """
+    A Jacobian buffer that holds only some of the columns of J, but is
+    indexed with the global column offsets, as in J[:, offset]. Used when
+    several threads assemble the Jacobian, so that each one only allocates
+    the columns its models write to. Only the NumPy paths of the models,
+    which write J one column at a time, accept it.
+
+    array: (Q_Nx * Q_Ny, len(columns)) buffer
+    columns: global offsets of the columns held in array, in order
+    """
+
+    def __init__(self, array, columns):
+        self.array = array
+        self.columns = columns
+        self._local = {int(c): i for i, c in enumerate(columns)}
+
+    def __getitem__(self, key):
+        rows, col = key
+        return self.array[rows, self._local[int(col)]]
+
+    def __setitem__(self, key, value):
+        rows, col = key
+        self.array[rows, self._local[int(col)]] = value
+
+
+def _distance(xp, dx, dy):
+    """
+    sqrt(dx**2 + dy**2), evaluated in a single temporary. This is several
+    times faster than np.hypot, whose guard against overflow is not needed
+    for distances in pixels.
+    """
+    r = dx * dx
+    r += dy * dy
+    return xp.sqrt(r, out=r)
+
+
+def _expit(array):
+    """
+    scipy.special.expit on either device.
+    """
+    if cp is not None and isinstance(array, cp.ndarray):
+        return cp_expit(array)
+    return expit(array)
 
 
 class WPFModelType(Flag):
@@ -42,6 +121,10 @@ class WPFModel:
                         • keyword arguments. this is to provide some pre-computed information for convenience
     """
 
+    # whether func and jacobian run Numba kernels when numba is installed,
+    # which must not be launched from several threads at once
+    _uses_numba = False
+
     def __init__(self, name: str, params: dict, model_type=WPFModelType.DUMMY):
         self.name = name
         self.params = params
@@ -55,6 +138,26 @@ class WPFModel:
     def func(self, DP: np.ndarray, x, **kwargs) -> None:
         raise NotImplementedError()
 
+    def finalize_offsets(self) -> None:
+        """
+        Gather the offsets of all Parameters, in the order of the params dict,
+        into a contiguous index array. This is called by WholePatternFit once
+        the offsets have been assigned, so that the hot paths can read all of
+        the model parameters from x with a single gather instead of a dict and
+        attribute lookup per parameter.
+        """
+        self._offsets = self._gather_offsets(self.params)
+        # the columns of J that jacobian writes to
+        self._jacobian_offsets = self._offsets
+
+    def _gather_offsets(self, keys) -> np.ndarray:
+        """
+        Return the offsets of the Parameters named by keys as an index array.
+        """
+        return np.fromiter(
+            (self.params[k].offset for k in keys), dtype=np.intp, count=len(keys)
+        )
+
     # Required signature for the Jacobian:
     #
     # def jacobian(self, J: np.ndarray, *args, offset: int, **kwargs) -> None:
@@ -147,10 +250,10 @@ class DCBackground(WPFModel):
         super().__init__(name, params, model_type=WPFModelType.BACKGROUND)
 
     def func(self, DP: np.ndarray, x, **kwargs) -> None:
-        DP += x[self.params["DC Level"].offset]
+        DP += x[self._offsets[0]]
 
     def jacobian(self, J: np.ndarray, *args, **kwargs):
-        J[:, self.params["DC Level"].offset] = 1
+        J[:, self._offsets[0]] = 1
 
 
 class GaussianBackground(WPFModel):
@@ -181,6 +284,8 @@ class GaussianBackground(WPFModel):
             Parameter documentation for details.
     """
 
+    _uses_numba = True
+
     def __init__(
         self,
         WPF,
@@ -202,43 +307,70 @@ class GaussianBackground(WPFModel):
         super().__init__(name, params, model_type=WPFModelType.BACKGROUND)
 
     def func(self, DP: np.ndarray, x: np.ndarray, **kwargs) -> None:
-        sigma = x[self.params["sigma"].offset]
-        level = x[self.params["intensity"].offset]
+        sigma, level, x0, y0 = x[self._offsets]
+        xp = _get_array_module(DP)
+
+        if nb is not None and xp is np:
+            _gauss_bg_func(DP, kwargs["xArray"], kwargs["yArray"], x0, y0, sigma, level)
+            return
 
         r = kwargs["parent"]._get_distance(
-            x, self.params["x center"], self.params["y center"]
+            x, self.params["x center"], self.params["y center"], kwargs.get("scratch")
         )
 
-        DP += level * np.exp(r**2 / (-2 * sigma**2))
+        DP += level * xp.exp(r**2 / (-2 * sigma**2))
 
     def jacobian(self, J: np.ndarray, x: np.ndarray, **kwargs) -> None:
-        sigma = x[self.params["sigma"].offset]
-        level = x[self.params["intensity"].offset]
-        x0 = x[self.params["x center"].offset]
-        y0 = x[self.params["y center"].offset]
+        sigma, level, x0, y0 = x[self._offsets]
+        off_sig, off_int, off_x, off_y = self._offsets
+        xp = _get_array_module(J)
+
+        if nb is not None and xp is np:
+            _gauss_bg_jac(
+                J,
+                kwargs["xArray"],
+                kwargs["yArray"],
+                x0,
+                y0,
+                sigma,
+                level,
+                off_x,
+                off_y,
+                off_sig,
+                off_int,
+            )
+            return
 
-        r = kwargs["parent"]._get_distance(
-            x, self.params["x center"], self.params["y center"]
-        )
-        exp_expr = np.exp(r**2 / (-2 * sigma**2))
+        WPF = kwargs["parent"]
+        center = (self.params["x center"], self.params["y center"])
+        r = WPF._get_distance(x, *center, kwargs.get("scratch"))
+        dx, dy = WPF._get_shifted_grids(x, *center, kwargs.get("scratch"))
+
+        exp_expr = xp.square(r)
+        exp_expr *= -1.0 / (2 * sigma**2)
+        xp.exp(exp_expr, out=exp_expr)
+
+        # each partial is built in place in one buffer before it is added to J
+        col = xp.empty_like(exp_expr)
 
         # dF/d(x0)
-        J[:, self.params["x center"].offset] += (
-            level * (kwargs["xArray"] - x0) * exp_expr / sigma**2
-        ).ravel()
+        xp.multiply(dx, exp_expr, out=col)
+        col *= level / sigma**2
+        J[:, off_x] += col.ravel()
 
         # dF/d(y0)
-        J[:, self.params["y center"].offset] += (
-            level * (kwargs["yArray"] - y0) * exp_expr / sigma**2
-        ).ravel()
+        xp.multiply(dy, exp_expr, out=col)
+        col *= level / sigma**2
+        J[:, off_y] += col.ravel()
 
         # dF/s(sigma)
-        J[:, self.params["sigma"].offset] += (
-            level * r**2 * exp_expr / sigma**3
-        ).ravel()
+        xp.square(r, out=col)
+        col *= exp_expr
+        col *= level / sigma**3
+        J[:, off_sig] += col.ravel()
 
         # dF/d(level)
-        J[:, self.params["intensity"].offset] += exp_expr.ravel()
+        J[:, off_int] += exp_expr.ravel()
 
 
 class GaussianRing(WPFModel):
@@ -274,6 +406,8 @@ class GaussianRing(WPFModel):
             Parameter documentation for details.
     """
 
+    _uses_numba = True
+
     def __init__(
         self,
         WPF,
@@ -304,62 +438,83 @@ class GaussianRing(WPFModel):
         super().__init__(name, params, model_type=WPFModelType.AMORPHOUS)
 
     def func(self, DP: np.ndarray, x: np.ndarray, **kwargs) -> None:
-        radius = x[self.params["radius"].offset]
-        sigma = x[self.params["sigma"].offset]
-        level = x[self.params["level"].offset]
+        radius, sigma, level, x0, y0 = x[self._offsets]
+        xp = _get_array_module(DP)
+
+        if nb is not None and xp is np:
+            _gauss_ring_func(
+                DP, kwargs["xArray"], kwargs["yArray"], x0, y0, radius, sigma, level
+            )
+            return
 
         r = kwargs["parent"]._get_distance(
-            x, self.params["x center"], self.params["y center"]
+            x, self.params["x center"], self.params["y center"], kwargs.get("scratch")
         )
 
-        DP += level * np.exp((r - radius) ** 2 / (-2 * sigma**2))
+        DP += level * xp.exp((r - radius) ** 2 / (-2 * sigma**2))
 
     def jacobian(self, J: np.ndarray, x: np.ndarray, **kwargs) -> None:
-        radius = x[self.params["radius"].offset]
-        sigma = x[self.params["sigma"].offset]
-        level = x[self.params["level"].offset]
+        radius, sigma, level, x0, y0 = x[self._offsets]
+        off_radius, off_sigma, off_int, off_x, off_y = self._offsets
+        xp = _get_array_module(J)
+
+        if nb is not None and xp is np:
+            _gauss_ring_jac(
+                J,
+                kwargs["xArray"],
+                kwargs["yArray"],
+                x0,
+                y0,
+                radius,
+                sigma,
+                level,
+                off_x,
+                off_y,
+                off_radius,
+                off_sigma,
+                off_int,
+            )
+            return
 
-        x0 = x[self.params["x center"].offset]
-        y0 = x[self.params["y center"].offset]
-        r = kwargs["parent"]._get_distance(
-            x, self.params["x center"], self.params["y center"]
-        )
+        WPF = kwargs["parent"]
+        center = (self.params["x center"], self.params["y center"])
+        r = WPF._get_distance(x, *center, kwargs.get("scratch"))
+        dx, dy = WPF._get_shifted_grids(x, *center, kwargs.get("scratch"))
 
         local_r = radius - r
-        clipped_r = np.maximum(local_r, 0.1)
 
-        exp_expr = np.exp(local_r**2 / (-2 * sigma**2))
+        exp_expr = xp.square(local_r)
+        exp_expr *= -1.0 / (2 * sigma**2)
+        xp.exp(exp_expr, out=exp_expr)
+
+        # each partial is built in place in one buffer before it is added to J
+        col = xp.empty_like(exp_expr)
+
+        # dF/d(radius)
+        d_radius = exp_expr * local_r
+        d_radius *= -1.0 * level / sigma**2
+        J[:, off_radius] += d_radius.ravel()
+
+        # the center partials are the radius partial times (x - x0) / r
+        xp.maximum(r, 0.1, out=col)
+        d_radius /= col
 
         # dF/d(x0)
-        J[:, self.params["x center"].offset] += (
-            level
-            * exp_expr
-            * (kwargs["xArray"] - x0)
-            * local_r
-            / (sigma**2 * clipped_r)
-        ).ravel()
+        xp.multiply(dx, d_radius, out=col)
+        J[:, off_x] += col.ravel()
 
         # dF/d(y0)
-        J[:, self.parans["y center"].offset] += (
-            level
-            * exp_expr
-            * (kwargs["yArray"] - y0)
-            * local_r
-            / (sigma**2 * clipped_r)
-        ).ravel()
-
-        # dF/d(radius)
-        J[:, self.params["radius"].offset] += (
-            -1.0 * level * exp_expr * local_r / (sigma**2)
-        ).ravel()
+        xp.multiply(dy, d_radius, out=col)
+        J[:, off_y] += col.ravel()
 
         # dF/d(sigma)
-        J[:, self.params["sigma"].offset] += (
-            level * local_r**2 * exp_expr / sigma**3
-        ).ravel()
+        xp.square(local_r, out=col)
+        col *= exp_expr
+        col *= level / sigma**3
+        J[:, off_sigma] += col.ravel()
 
         # dF/d(intensity)
-        J[:, self.params["intensity"].offset] += exp_expr.ravel()
+        J[:, off_int] += exp_expr.ravel()
 
 
 class SyntheticDiskLattice(WPFModel):
@@ -413,6 +568,8 @@ class SyntheticDiskLattice(WPFModel):
         If specified, only the indices in the list are added to the pattern
     """
 
+    _uses_numba = True
+
     def __init__(
         self,
         WPF,
@@ -463,38 +620,46 @@ class SyntheticDiskLattice(WPFModel):
             self.u_inds = u_inds.ravel()
             self.v_inds = v_inds.ravel()
 
-            delete_mask = np.zeros_like(self.u_inds, dtype=bool)
-            for i, (u, v) in enumerate(zip(u_inds.ravel(), v_inds.ravel())):
-                x = (
-                    x0
-                    + (u * params["ux"].initial_value)
-                    + (v * params["vx"].initial_value)
-                )
-                y = (
-                    y0
-                    + (u * params["uy"].initial_value)
-                    + (v * params["vy"].initial_value)
-                )
-                if [u, v] in exclude_indices:
-                    delete_mask[i] = True
-                elif (x < 0) or (x > Q_Nx) or (y < 0) or (y > Q_Ny):
-                    delete_mask[i] = True
-                    if verbose:
-                        print(
-                            f"Excluding peak [{u},{v}] because it is outside the pattern..."
-                        )
-                else:
-                    params[f"[{u},{v}] Intensity"] = Parameter(intensity_0)
+            x = (
+                x0
+                + (self.u_inds * params["ux"].initial_value)
+                + (self.v_inds * params["vx"].initial_value)
+            )
+            y = (
+                y0
+                + (self.u_inds * params["uy"].initial_value)
+                + (self.v_inds * params["vy"].initial_value)
+            )
+            inside = (x >= 0) & (x <= Q_Nx) & (y >= 0) & (y <= Q_Ny)
+
+            excl = frozenset((int(u), int(v)) for u, v in exclude_indices)
+            excluded = np.fromiter(
+                ((int(u), int(v)) in excl for u, v in zip(self.u_inds, self.v_inds)),
+                dtype=bool,
+                count=self.u_inds.shape[0],
+            )
 
-            self.u_inds = self.u_inds[~delete_mask]
-            self.v_inds = self.v_inds[~delete_mask]
+            if verbose:
+                clipped = ~inside & ~excluded
+                for u, v in zip(self.u_inds[clipped], self.v_inds[clipped]):
+                    print(
+                        f"Excluding peak [{u},{v}] because it is outside the pattern..."
+                    )
+
+            keep = inside & ~excluded
+            self.u_inds = self.u_inds[keep]
+            self.v_inds = self.v_inds[keep]
         else:
-            for ind in include_indices:
-                params[f"[{ind[0]},{ind[1]}] Intensity"] = Parameter(intensity_0)
             inds = np.array(include_indices)
             self.u_inds = inds[:, 0]
             self.v_inds = inds[:, 1]
 
+        self._intensity_keys = [
+            f"[{u},{v}] Intensity" for u, v in zip(self.u_inds, self.v_inds)
+        ]
+        for key in self._intensity_keys:
+            params[key] = Parameter(intensity_0)
+
         self.refine_radius = refine_radius
         self.refine_width = refine_width
         if refine_radius:
@@ -504,141 +669,221 @@ class SyntheticDiskLattice(WPFModel):
 
         super().__init__(name, params, model_type=WPFModelType.LATTICE)
 
-    def func(self, DP: np.ndarray, x: np.ndarray, **static_data) -> None:
-        x0 = x[self.params["x center"].offset]
-        y0 = x[self.params["y center"].offset]
-        ux = x[self.params["ux"].offset]
-        uy = x[self.params["uy"].offset]
-        vx = x[self.params["vx"].offset]
-        vy = x[self.params["vy"].offset]
+    def finalize_offsets(self) -> None:
+        super().finalize_offsets()
 
-        disk_radius = (
-            x[self.params["disk radius"].offset]
-            if self.refine_radius
-            else self.disk_radius
+        self._center_offsets = self._gather_offsets(["x center", "y center"])
+        self._lattice_offsets = self._gather_offsets(["ux", "uy", "vx", "vy"])
+        self._intensity_offsets = self._gather_offsets(self._intensity_keys)
+        # -1 flags a disk parameter that is not refined
+        self._radius_offset = (
+            self.params["disk radius"].offset if self.refine_radius else -1
         )
-
-        disk_width = (
-            x[self.params["edge width"].offset]
-            if self.refine_width
-            else self.disk_width
+        self._width_offset = (
+            self.params["edge width"].offset if self.refine_width else -1
         )
 
-        for i, (u, v) in enumerate(zip(self.u_inds, self.v_inds)):
-            x_pos = x0 + (u * ux) + (v * vx)
-            y_pos = y0 + (u * uy) + (v * vy)
-
-            DP += x[self.params[f"[{u},{v}] Intensity"].offset] / (
-                1.0
-                + np.exp(
-                    np.minimum(
-                        4
-                        * (
-                            np.sqrt(
-                                (static_data["xArray"] - x_pos) ** 2
-                                + (static_data["yArray"] - y_pos) ** 2
-                            )
-                            - disk_radius
-                        )
-                        / disk_width,
-                        20,
-                    )
+    def func(self, DP: np.ndarray, x: np.ndarray, **static_data) -> None:
+        x0, y0 = x[self._center_offsets]
+        ux, uy, vx, vy = x[self._lattice_offsets]
+
+        disk_radius = x[self._radius_offset] if self.refine_radius else self.disk_radius
+        disk_width = x[self._width_offset] if self.refine_width else self.disk_width
+
+        intensities = x[self._intensity_offsets]
+        xp = _get_array_module(DP)
+
+        if nb is not None and xp is np:
+            _disk_lattice_func(
+                DP,
+                static_data["xArray"],
+                static_data["yArray"],
+                x0,
+                y0,
+                ux,
+                uy,
+                vx,
+                vy,
+                self.u_inds,
+                self.v_inds,
+                intensities,
+                disk_radius,
+                disk_width,
+            )
+            return
+
+        # the logistic edge is below 1e-8 beyond 5 edge widths outside the
+        # disk radius, so each disk is only evaluated inside that window
+        cutoff = disk_radius + 5.0 * disk_width
+
+        if xp is not np:
+            # on the GPU a loop over the peaks would launch several tiny
+            # kernels per peak, so as in jacobian the peaks are broadcast over
+            # (peak, Q_Nx, Q_Ny) in blocks instead
+            x_center, y_center = static_data["parent"]._get_shifted_grids(
+                x,
+                self.params["x center"],
+                self.params["y center"],
+                static_data.get("scratch"),
+            )
+            x_pos = xp.asarray((self.u_inds * ux) + (self.v_inds * vx), DP.dtype)
+            y_pos = xp.asarray((self.u_inds * uy) + (self.v_inds * vy), DP.dtype)
+            intensities = xp.asarray(intensities)
+
+            block = max(1, _MAX_BLOCK_ELEMENTS // x_center.size)
+            for start in range(0, x_pos.shape[0], block):
+                sl = slice(start, start + block)
+                r_disk = _distance(
+                    xp,
+                    x_center - x_pos[sl, np.newaxis, np.newaxis],
+                    y_center - y_pos[sl, np.newaxis, np.newaxis],
                 )
+                disks = xp.where(
+                    r_disk < cutoff,
+                    _expit(4.0 * (disk_radius - r_disk) / disk_width),
+                    0.0,
+                )
+                DP += xp.tensordot(intensities[sl], disks, axes=1)
+            return
+
+        xArray = static_data["xArray"]
+        yArray = static_data["yArray"]
+        x_pos = x0 + (self.u_inds * ux) + (self.v_inds * vx)
+        y_pos = y0 + (self.u_inds * uy) + (self.v_inds * vy)
+        Q_Nx, Q_Ny = DP.shape
+        x_lo = np.clip(np.floor(x_pos - cutoff).astype(int), 0, Q_Nx)
+        x_hi = np.clip(np.ceil(x_pos + cutoff).astype(int) + 1, 0, Q_Nx)
+        y_lo = np.clip(np.floor(y_pos - cutoff).astype(int), 0, Q_Ny)
+        y_hi = np.clip(np.ceil(y_pos + cutoff).astype(int) + 1, 0, Q_Ny)
+
+        for k in range(x_pos.shape[0]):
+            window = np.s_[x_lo[k] : x_hi[k], y_lo[k] : y_hi[k]]
+            dx = xArray[window] - x_pos[k]
+            dy = yArray[window] - y_pos[k]
+            r_disk = _distance(xp, dx, dy)
+
+            DP[window] += intensities[k] * xp.where(
+                r_disk < cutoff, _expit(4.0 * (disk_radius - r_disk) / disk_width), 0.0
             )
 
     def jacobian(self, J: np.ndarray, x: np.ndarray, **static_data) -> None:
-        x0 = x[self.params["x center"].offset]
-        y0 = x[self.params["y center"].offset]
-        ux = x[self.params["ux"].offset]
-        uy = x[self.params["uy"].offset]
-        vx = x[self.params["vx"].offset]
-        vy = x[self.params["vy"].offset]
+        x0, y0 = x[self._center_offsets]
+        ux, uy, vx, vy = x[self._lattice_offsets]
         WPF = static_data["parent"]
 
-        r = np.maximum(
-            5e-1, WPF._get_distance(x, self.params["x center"], self.params["y center"])
-        )
-
-        disk_radius = (
-            x[self.params["disk radius"].offset]
-            if self.refine_radius
-            else self.disk_radius
-        )
-
-        disk_width = (
-            x[self.params["edge width"].offset]
-            if self.refine_width
-            else self.disk_width
-        )
-
-        for i, (u, v) in enumerate(zip(self.u_inds, self.v_inds)):
-            x_pos = x0 + (u * ux) + (v * vx)
-            y_pos = y0 + (u * uy) + (v * vy)
+        disk_radius = x[self._radius_offset] if self.refine_radius else self.disk_radius
+        disk_width = x[self._width_offset] if self.refine_width else self.disk_width
 
-            disk_intensity = x[self.params[f"[{u},{v}] Intensity"].offset]
+        intensities = x[self._intensity_offsets]
+        xp = _get_array_module(J)
 
-            r_disk = np.maximum(
-                5e-1,
-                np.sqrt(
-                    (static_data["xArray"] - x_pos) ** 2
-                    + (static_data["yArray"] - y_pos) ** 2
-                ),
+        if nb is not None and xp is np:
+            jac_kernel = _disk_lattice_jac_kernel(
+                bool(self.refine_radius), bool(self.refine_width)
             )
+            jac_kernel(
+                J,
+                static_data["xArray"],
+                static_data["yArray"],
+                x0,
+                y0,
+                ux,
+                uy,
+                vx,
+                vy,
+                self.u_inds,
+                self.v_inds,
+                intensities,
+                disk_radius,
+                disk_width,
+                self._center_offsets,
+                self._lattice_offsets,
+                self._intensity_offsets,
+                self._radius_offset,
+                self._width_offset,
+            )
+            return
 
-            mask = r_disk < (2 * disk_radius)
+        center = (self.params["x center"], self.params["y center"])
+        x_center, y_center = WPF._get_shifted_grids(
+            x, *center, static_data.get("scratch")
+        )
 
-            top_exp = mask * np.exp(
-                np.minimum(30, 4 * ((mask * r_disk) - disk_radius) / disk_width)
+        # the per-peak vectors are broadcast against the pattern, so they
+        # have to live on the same device
+        u_inds = xp.asarray(self.u_inds)
+        v_inds = xp.asarray(self.v_inds)
+        intensities = xp.asarray(intensities)
+        # disk positions relative to the center
+        x_pos = (u_inds * ux) + (v_inds * vx)
+        y_pos = (u_inds * uy) + (v_inds * vy)
+
+        # same cutoff as func, so that the Jacobian covers every pixel the
+        # disks contribute to
+        cutoff = disk_radius + 5.0 * disk_width
+
+        # evaluate the peaks in blocks, broadcasting over (peak, Q_Nx, Q_Ny)
+        block = max(1, _MAX_BLOCK_ELEMENTS // x_center.size)
+        for start in range(0, x_pos.shape[0], block):
+            sl = slice(start, start + block)
+            u = u_inds[sl]
+            v = v_inds[sl]
+            disk_intensity = intensities[sl]
+
+            dx = x_center - x_pos[sl, np.newaxis, np.newaxis]
+            dy = y_center - y_pos[sl, np.newaxis, np.newaxis]
+            r_disk = _distance(xp, dx, dy)
+
+            mask = r_disk < cutoff
+
+            top_exp = mask * xp.exp(
+                xp.minimum(30, 4 * ((mask * r_disk) - disk_radius) / disk_width)
             )
+            # 4 * top_exp / (disk_width * (1 + top_exp)^2), shared by all partials
+            d_exp = 4.0 * top_exp / (disk_width * (1.0 + top_exp) ** 2)
 
-            # dF/d(x0)
-            dx = (
-                4
-                * disk_intensity
-                * (static_data["xArray"] - x_pos)
-                * top_exp
-                / ((1.0 + top_exp) ** 2 * disk_width * r)
-            ).ravel()
-
-            # dF/d(y0)
-            dy = (
-                4
-                * disk_intensity
-                * (static_data["yArray"] - y_pos)
-                * top_exp
-                / ((1.0 + top_exp) ** 2 * disk_width * r)
-            ).ravel()
+            # dF/d(x0), dF/d(y0), each still to be weighted by disk_intensity
+            d_exp_r = d_exp / xp.maximum(1e-6, r_disk)
+            dx *= d_exp_r
+            dy *= d_exp_r
 
             # insert center position derivatives
-            J[:, self.params["x center"].offset] += disk_intensity * dx
-            J[:, self.params["y center"].offset] += disk_intensity * dy
+            J[:, self._center_offsets[0]] += xp.tensordot(
+                disk_intensity, dx, axes=1
+            ).ravel()
+            J[:, self._center_offsets[1]] += xp.tensordot(
+                disk_intensity, dy, axes=1
+            ).ravel()
 
             # insert lattice vector derivatives
-            J[:, self.params["ux"].offset] += disk_intensity * u * dx
-            J[:, self.params["uy"].offset] += disk_intensity * u * dy
-            J[:, self.params["vx"].offset] += disk_intensity * v * dx
-            J[:, self.params["vy"].offset] += disk_intensity * v * dy
+            J[:, self._lattice_offsets[0]] += xp.tensordot(
+                disk_intensity * u, dx, axes=1
+            ).ravel()
+            J[:, self._lattice_offsets[1]] += xp.tensordot(
+                disk_intensity * u, dy, axes=1
+            ).ravel()
+            J[:, self._lattice_offsets[2]] += xp.tensordot(
+                disk_intensity * v, dx, axes=1
+            ).ravel()
+            J[:, self._lattice_offsets[3]] += xp.tensordot(
+                disk_intensity * v, dy, axes=1
+            ).ravel()
 
-            # insert intensity derivative
-            dI = (mask * (1.0 / (1.0 + top_exp))).ravel()
-            J[:, self.params[f"[{u},{v}] Intensity"].offset] += dI
+            # insert intensity derivatives
+            dI = mask / (1.0 + top_exp)
+            for k, offset in enumerate(self._intensity_offsets[sl]):
+                J[:, offset] += dI[k].ravel()
 
             # insert disk radius derivative
             if self.refine_radius:
-                dR = (
-                    4.0 * disk_intensity * top_exp / (disk_width * (1.0 + top_exp) ** 2)
+                J[:, self._radius_offset] += xp.tensordot(
+                    disk_intensity, d_exp, axes=1
                 ).ravel()
-                J[:, self.params["disk radius"].offset] += dR
 
             if self.refine_width:
-                dW = (
-                    4.0
-                    * disk_intensity
-                    * top_exp
-                    * (r_disk - disk_radius)
-                    / (disk_width**2 * (1.0 + top_exp) ** 2)
+                J[:, self._width_offset] += xp.tensordot(
+                    disk_intensity, d_exp * (r_disk - disk_radius) / disk_width, axes=1
                 ).ravel()
-                J[:, self.params["edge width"].offset] += dW
 
 
 class SyntheticDiskMoire(WPFModel):
@@ -851,13 +1096,18 @@ class SyntheticDiskMoire(WPFModel):
                 f"Order {n} Moire Intensity": Parameter(intensity_0)
                 for n in range(max_order + 1)
             }
+            # Each peak has an intensity based on the max index of parent lattice
+            # which it decorates
+            self._intensity_keys = [
+                f"Order {int(np.max(np.abs(indices[:4])))} Moire Intensity"
+                for indices in self.moire_indices_uvm
+            ]
         else:
-            params = {
-                f"a ({ax},{ay}), b ({bx},{by}), moire ({mx},{my}) Intensity": Parameter(
-                    intensity_0
-                )
+            self._intensity_keys = [
+                f"a ({ax},{ay}), b ({bx},{by}), moire ({mx},{my}) Intensity"
                 for ax, ay, bx, by, mx, my in self.moire_indices_uvm
-            }
+            ]
+            params = {key: Parameter(intensity_0) for key in self._intensity_keys}
 
         params["x center"] = lattice_a.params["x center"]
         params["y center"] = lattice_a.params["y center"]
@@ -901,6 +1151,16 @@ class SyntheticDiskMoire(WPFModel):
             model_type=WPFModelType.META | WPFModelType.MOIRE,
         )
 
+    def finalize_offsets(self) -> None:
+        super().finalize_offsets()
+
+        # offset of the intensity parameter of each moire peak
+        self._intensity_offsets = self._gather_offsets(self._intensity_keys)
+        # the Jacobian also has derivatives for the parent lattice vectors
+        self._jacobian_offsets = np.union1d(
+            self._offsets, [p.offset for p, _ in self.parent_vector_selectors]
+        ).astype(np.intp)
+
     def _get_parent_lattices(self, lattice_a, lattice_b):
         lat_a = np.array(
             [
@@ -936,6 +1196,7 @@ class SyntheticDiskMoire(WPFModel):
 
         lat_ab = self._get_parent_lattices(self.lattice_a, self.lattice_b)
         lat_abm = np.vstack((lat_ab, self.moire_matrix @ lat_ab))
+        xp = _get_array_module(DP)
 
         # grab shared parameters
         disk_radius = (
@@ -950,43 +1211,22 @@ class SyntheticDiskMoire(WPFModel):
             else self.disk_width
         )
 
-        # compute positions of each moire peak
-        positions = self.moire_indices_uvm @ lat_abm
-        positions += np.array(
-            [x[self.params["x center"].offset], x[self.params["y center"].offset]]
+        # the pattern coordinates relative to the center
+        x_center, y_center = static_data["parent"]._get_shifted_grids(
+            x,
+            self.params["x center"],
+            self.params["y center"],
+            static_data.get("scratch"),
         )
 
-        for (x_pos, y_pos), indices in zip(positions, self.moire_indices_uvm):
-            # Each peak has an intensity based on the max index of parent lattice
-            # which it decorates
-            order = int(np.max(np.abs(indices[:4])))
+        # compute positions of each moire peak relative to the center
+        positions = (self.moire_indices_uvm @ lat_abm).astype(x.dtype)
 
-            if self.link_moire_disk_intensities:
-                intensity = x[self.params[f"Order {order} Moire Intensity"].offset]
-            else:
-                ax, ay, bx, by, mx, my = indices
-                intensity = x[
-                    self.params[
-                        f"a ({ax},{ay}), b ({bx},{by}), moire ({mx},{my}) Intensity"
-                    ].offset
-                ]
+        for (x_pos, y_pos), intensity in zip(positions, x[self._intensity_offsets]):
+            r_disk = _distance(xp, x_center - x_pos, y_center - y_pos)
 
             DP += intensity / (
-                1.0
-                + np.exp(
-                    np.minimum(
-                        4
-                        * (
-                            np.sqrt(
-                                (static_data["xArray"] - x_pos) ** 2
-                                + (static_data["yArray"] - y_pos) ** 2
-                            )
-                            - disk_radius
-                        )
-                        / disk_width,
-                        20,
-                    )
-                )
+                1.0 + xp.exp(xp.minimum(4 * (r_disk - disk_radius) / disk_width, 20))
             )
 
     def jacobian(self, J: np.ndarray, x: np.ndarray, **static_data):
@@ -994,6 +1234,7 @@ class SyntheticDiskMoire(WPFModel):
         # of the two parent lattices
         lat_ab = self._get_parent_lattices(self.lattice_a, self.lattice_b)
         lat_abm = np.vstack((lat_ab, self.moire_matrix @ lat_ab))
+        xp = _get_array_module(J)
 
         # grab shared parameters
         disk_radius = (
@@ -1008,69 +1249,57 @@ class SyntheticDiskMoire(WPFModel):
             else self.disk_width
         )
 
-        # distance from center coordinate
-        r = np.maximum(
-            5e-1,
-            static_data["parent"]._get_distance(
-                x, self.params["x center"], self.params["y center"]
-            ),
+        # the pattern coordinates relative to the center
+        WPF = static_data["parent"]
+        center = (self.params["x center"], self.params["y center"])
+        x_center, y_center = WPF._get_shifted_grids(
+            x, *center, static_data.get("scratch")
         )
 
-        # compute positions of each moire peak
-        positions = self.moire_indices_uvm @ lat_abm
-        positions += np.array(
-            [x[self.params["x center"].offset], x[self.params["y center"].offset]]
-        )
+        # func is below 1e-8 of the disk intensity beyond 5 edge widths
+        # outside the disk radius, so the derivatives are cut off there
+        cutoff = disk_radius + 5.0 * disk_width
 
-        for (x_pos, y_pos), indices in zip(positions, self.moire_indices_uvm):
-            # Each peak has an intensity based on the max index of parent lattice
-            # which it decorates
-            if self.link_moire_disk_intensities:
-                order = int(np.max(np.abs(indices[:4])))
-                intensity_idx = self.params[f"Order {order} Moire Intensity"].offset
-            else:
-                ax, ay, bx, by, mx, my = indices
-                intensity_idx = self.params[
-                    f"a ({ax},{ay}), b ({bx},{by}), moire ({mx},{my}) Intensity"
-                ].offset
+        # compute positions of each moire peak relative to the center
+        positions = (self.moire_indices_uvm @ lat_abm).astype(x.dtype)
+
+        for (x_pos, y_pos), indices, intensity_idx in zip(
+            positions, self.moire_indices_uvm, self._intensity_offsets
+        ):
             disk_intensity = x[intensity_idx]
 
-            r_disk = np.maximum(
-                5e-1,
-                np.sqrt(
-                    (static_data["xArray"] - x_pos) ** 2
-                    + (static_data["yArray"] - y_pos) ** 2
-                ),
-            )
+            x_shift = x_center - x_pos
+            y_shift = y_center - y_pos
+            r_disk = _distance(xp, x_shift, y_shift)
 
-            mask = r_disk < (2 * disk_radius)
+            mask = r_disk < cutoff
 
             # clamp the argument of the exponent at a very large finite value
-            top_exp = mask * np.exp(
-                np.minimum(30, 4 * ((mask * r_disk) - disk_radius) / disk_width)
+            top_exp = mask * xp.exp(
+                xp.minimum(30, 4 * ((mask * r_disk) - disk_radius) / disk_width)
             )
 
             # dF/d(x0)
             dx = (
                 4
                 * disk_intensity
-                * (static_data["xArray"] - x_pos)
+                * x_shift
                 * top_exp
-                / ((1.0 + top_exp) ** 2 * disk_width * r)
+                / ((1.0 + top_exp) ** 2 * disk_width * xp.maximum(1e-6, r_disk))
             ).ravel()
 
             # dF/d(y0)
             dy = (
                 4
                 * disk_intensity
-                * (static_data["yArray"] - y_pos)
+                * y_shift
                 * top_exp
-                / ((1.0 + top_exp) ** 2 * disk_width * r)
+                / ((1.0 + top_exp) ** 2 * disk_width * xp.maximum(1e-6, r_disk))
             ).ravel()
 
             # insert center position derivatives
-            J[:, self.params["x center"].offset] += disk_intensity * dx
-            J[:, self.params["y center"].offset] += disk_intensity * dy
+            J[:, self.params["x center"].offset] += dx
+            J[:, self.params["y center"].offset] += dy
 
             # insert lattice vector derivatives
             for par, mat in self.parent_vector_selectors:
@@ -1078,7 +1307,7 @@ class SyntheticDiskMoire(WPFModel):
                 # disk in terms of each of the parent lattice vectors
                 d_abm = np.vstack((mat, self.moire_matrix @ mat))
                 d_param = indices @ d_abm
-                J[:, par.offset] += disk_intensity * (d_param[0] * dx + d_param[1] * dy)
+                J[:, par.offset] += d_param[0] * dx + d_param[1] * dy
 
             # insert intensity derivative
             dI = (mask * (1.0 / (1.0 + top_exp))).ravel()
@@ -1127,7 +1356,8 @@ class ComplexOverlapKernelDiskLattice(WPFModel):
 
         params = {}
 
-        self.probe_kernelFT = np.fft.fft2(probe_kernel)
+        xp = WPF._xp
+        self.probe_kernelFT = xp.fft.fft2(xp.asarray(probe_kernel))
 
         if global_center:
             params["x center"] = WPF.coordinate_model.params["x center"]
@@ -1152,9 +1382,11 @@ class ComplexOverlapKernelDiskLattice(WPFModel):
         Q_Nx = WPF.static_data["Q_Nx"]
         Q_Ny = WPF.static_data["Q_Ny"]
 
-        self.yqArray = np.tile(np.fft.fftfreq(Q_Ny)[np.newaxis, :], (Q_Nx, 1))
-        self.xqArray = np.tile(np.fft.fftfreq(Q_Nx)[:, np.newaxis], (1, Q_Ny))
+        # the Fourier shift is separable, so only the 1D frequencies are stored
+        self._xq1d = xp.fft.fftfreq(Q_Nx)
+        self._yq1d = xp.fft.fftfreq(Q_Ny)
 
+        excl = frozenset((int(u), int(v)) for u, v in exclude_indices)
         for i, (u, v) in enumerate(zip(u_inds.ravel(), v_inds.ravel())):
             x = (
                 WPF.static_data["global_x0"]
@@ -1166,7 +1398,7 @@ class ComplexOverlapKernelDiskLattice(WPFModel):
                 + (u * params["uy"].initial_value)
                 + (v * params["vy"].initial_value)
             )
-            if [u, v] in exclude_indices:
+            if (int(u), int(v)) in excl:
                 delete_mask[i] = True
             elif (x < 0) or (x > Q_Nx) or (y < 0) or (y > Q_Ny):
                 delete_mask[i] = True
@@ -1174,20 +1406,34 @@ class ComplexOverlapKernelDiskLattice(WPFModel):
                     print(
                         f"Excluding peak [{u},{v}] because it is outside the pattern..."
                     )
-            else:
-                params[f"[{u},{v}] Intensity"] = Parameter(intensity_0)
-                if u == 0 and v == 0:
-                    params[f"[{u}, {v}] Phase"] = Parameter(
-                        0.0, 0.0, 0.0
-                    )  # direct beam clamped at zero phase
-                else:
-                    params[f"[{u}, {v}] Phase"] = Parameter(0.01, -np.pi, np.pi)
 
         self.u_inds = self.u_inds[~delete_mask]
         self.v_inds = self.v_inds[~delete_mask]
 
+        self._intensity_keys = [
+            f"[{u},{v}] Intensity" for u, v in zip(self.u_inds, self.v_inds)
+        ]
+        self._phase_keys = [
+            f"[{u}, {v}] Phase" for u, v in zip(self.u_inds, self.v_inds)
+        ]
+        for u, v, int_key, phase_key in zip(
+            self.u_inds, self.v_inds, self._intensity_keys, self._phase_keys
+        ):
+            params[int_key] = Parameter(intensity_0)
+            if u == 0 and v == 0:
+                # direct beam clamped at zero phase
+                params[phase_key] = Parameter(0.0, 0.0, 0.0)
+            else:
+                params[phase_key] = Parameter(0.01, -np.pi, np.pi)
+
         super().__init__(name, params, model_type=WPFModelType.LATTICE)
 
+    def finalize_offsets(self) -> None:
+        super().finalize_offsets()
+
+        self._intensity_offsets = self._gather_offsets(self._intensity_keys)
+        self._phase_offsets = self._gather_offsets(self._phase_keys)
+
     def func(self, DP: np.ndarray, x_fit, **kwargs) -> None:
         x0 = x_fit[self.params["x center"].offset]
         y0 = x_fit[self.params["y center"].offset]
@@ -1196,24 +1442,21 @@ class ComplexOverlapKernelDiskLattice(WPFModel):
         vx = x_fit[self.params["vx"].offset]
         vy = x_fit[self.params["vy"].offset]
 
-        localDP = np.zeros_like(DP, dtype=np.complex64)
+        xp = _get_array_module(DP)
+        localDP = xp.zeros_like(DP, dtype=np.complex64)
 
-        for i, (u, v) in enumerate(zip(self.u_inds, self.v_inds)):
-            x = x0 + (u * ux) + (v * vx)
-            y = y0 + (u * uy) + (v * vy)
+        x_pos = x0 + (self.u_inds * ux) + (self.v_inds * vx)
+        y_pos = y0 + (self.u_inds * uy) + (self.v_inds * vy)
+        amplitudes = xp.asarray(
+            x_fit[self._intensity_offsets] * np.exp(1j * x_fit[self._phase_offsets])
+        )
 
-            localDP += (
-                x_fit[self.params[f"[{u},{v}] Intensity"].offset]
-                * np.exp(1j * x_fit[self.params[f"[{u},{v}] Phase"].offset])
-                * np.abs(
-                    np.fft.ifft2(
-                        self.probe_kernelFT
-                        * np.exp(-2j * np.pi * (self.xqArray * x + self.yqArray * y))
-                    )
-                )
-            )
+        for sl, kernels in _shifted_kernel_blocks(
+            self.probe_kernelFT, self._xq1d, self._yq1d, x_pos, y_pos
+        ):
+            localDP += xp.tensordot(amplitudes[sl], kernels, axes=1)
 
-        DP += np.abs(localDP) ** 2
+        DP += xp.abs(localDP) ** 2
 
 
 class KernelDiskLattice(WPFModel):
@@ -1237,7 +1480,8 @@ class KernelDiskLattice(WPFModel):
     ):
         params = {}
 
-        self.probe_kernelFT = np.fft.fft2(probe_kernel)
+        xp = WPF._xp
+        self.probe_kernelFT = xp.fft.fft2(xp.asarray(probe_kernel))
 
         if global_center:
             params["x center"] = WPF.coordinate_model.params["x center"]
@@ -1262,13 +1506,15 @@ class KernelDiskLattice(WPFModel):
         Q_Nx = WPF.static_data["Q_Nx"]
         Q_Ny = WPF.static_data["Q_Ny"]
 
-        self.yqArray = np.tile(np.fft.fftfreq(Q_Ny)[np.newaxis, :], (Q_Nx, 1))
-        self.xqArray = np.tile(np.fft.fftfreq(Q_Nx)[:, np.newaxis], (1, Q_Ny))
+        # the Fourier shift is separable, so only the 1D frequencies are stored
+        self._xq1d = xp.fft.fftfreq(Q_Nx)
+        self._yq1d = xp.fft.fftfreq(Q_Ny)
 
+        excl = frozenset((int(u), int(v)) for u, v in exclude_indices)
         for i, (u, v) in enumerate(zip(u_inds.ravel(), v_inds.ravel())):
             x = x0 + (u * params["ux"].initial_value) + (v * params["vx"].initial_value)
             y = y0 + (u * params["uy"].initial_value) + (v * params["vy"].initial_value)
-            if [u, v] in exclude_indices:
+            if (int(u), int(v)) in excl:
                 delete_mask[i] = True
             elif (x < 0) or (x > Q_Nx) or (y < 0) or (y > Q_Ny):
                 delete_mask[i] = True
@@ -1276,14 +1522,23 @@ class KernelDiskLattice(WPFModel):
                     print(
                         f"Excluding peak [{u},{v}] because it is outside the pattern..."
                     )
-            else:
-                params[f"[{u},{v}] Intensity"] = Parameter(intensity_0)
 
         self.u_inds = self.u_inds[~delete_mask]
         self.v_inds = self.v_inds[~delete_mask]
 
+        self._intensity_keys = [
+            f"[{u},{v}] Intensity" for u, v in zip(self.u_inds, self.v_inds)
+        ]
+        for key in self._intensity_keys:
+            params[key] = Parameter(intensity_0)
+
         super().__init__(name, params, model_type=WPFModelType.LATTICE)
 
+    def finalize_offsets(self) -> None:
+        super().finalize_offsets()
+
+        self._intensity_offsets = self._gather_offsets(self._intensity_keys)
+
     def func(self, DP: np.ndarray, x_fit: np.ndarray, **static_data) -> None:
         x0 = x_fit[self.params["x center"].offset]
         y0 = x_fit[self.params["y center"].offset]
@@ -1292,16 +1547,336 @@ class KernelDiskLattice(WPFModel):
         vx = x_fit[self.params["vx"].offset]
         vy = x_fit[self.params["vy"].offset]
 
-        for i, (u, v) in enumerate(zip(self.u_inds, self.v_inds)):
-            x = x0 + (u * ux) + (v * vx)
-            y = y0 + (u * uy) + (v * vy)
+        x_pos = x0 + (self.u_inds * ux) + (self.v_inds * vx)
+        y_pos = y0 + (self.u_inds * uy) + (self.v_inds * vy)
+        xp = _get_array_module(DP)
+        intensities = xp.asarray(x_fit[self._intensity_offsets])
 
-            DP += (
-                x_fit[self.params[f"[{u},{v}] Intensity"].offset]
-                * np.abs(
-                    np.fft.ifft2(
-                        self.probe_kernelFT
-                        * np.exp(-2j * np.pi * (self.xqArray * x + self.yqArray * y))
-                    )
-                )
-            ) ** 2
+        for sl, kernels in _shifted_kernel_blocks(
+            self.probe_kernelFT, self._xq1d, self._yq1d, x_pos, y_pos
+        ):
+            kernels *= kernels
+            DP += xp.tensordot(intensities[sl] ** 2, kernels, axes=1)
+
+
+def _shifted_kernel_blocks(probe_kernelFT, xq, yq, x_pos, y_pos):
+    """
+    Yield (slice, kernels) for consecutive blocks of peaks, where kernels holds
+    |IFFT(probe_kernelFT)| shifted to each (x_pos, y_pos) in the block.
+
+    The inverse FFTs of a block are computed as one batched call, and the
+    block size is chosen so the stack holds at most _MAX_BLOCK_ELEMENTS values.
+    All of the work is done on the device that probe_kernelFT lives on.
+    """
+    xp = _get_array_module(probe_kernelFT)
+    x_pos = xp.asarray(x_pos)
+    y_pos = xp.asarray(y_pos)
+
+    block = max(1, _MAX_BLOCK_ELEMENTS // probe_kernelFT.size)
+    for start in range(0, x_pos.shape[0], block):
+        sl = slice(start, start + block)
+        phx = xp.exp(-2j * np.pi * x_pos[sl, np.newaxis] * xq[np.newaxis, :])
+        phy = xp.exp(-2j * np.pi * y_pos[sl, np.newaxis] * yq[np.newaxis, :])
+        stack = probe_kernelFT * phx[:, :, np.newaxis]
+        stack *= phy[:, np.newaxis, :]
+        yield sl, xp.abs(xp.fft.ifft2(stack))
+
+
+# ======= NUMBA KERNELS ======= #
+
+if nb is not None:
+
+    @nb.njit(parallel=True, fastmath=True, cache=True)
+    def _gauss_bg_func(DP, xArray, yArray, x0, y0, sigma, level):
+        """
+        Add a GaussianBackground to DP in a single pass over the pattern.
+        """
+        Q_Ny = DP.shape[1]
+        for i in nb.prange(DP.shape[0] * Q_Ny):
+            ix = i // Q_Ny
+            iy = i - ix * Q_Ny
+            dx = xArray[ix, iy] - x0
+            dy = yArray[ix, iy] - y0
+            DP[ix, iy] += level * np.exp((dx * dx + dy * dy) / (-2.0 * sigma * sigma))
+
+    @nb.njit(parallel=True, fastmath=True, cache=True)
+    def _gauss_bg_jac(
+        J, xArray, yArray, x0, y0, sigma, level, off_x, off_y, off_sig, off_int
+    ):
+        """
+        Accumulate the four partial derivatives of a GaussianBackground into J
+        in a single pass over the pattern.
+        """
+        Q_Ny = xArray.shape[1]
+        for i in nb.prange(xArray.shape[0] * Q_Ny):
+            ix = i // Q_Ny
+            iy = i - ix * Q_Ny
+            dx = xArray[ix, iy] - x0
+            dy = yArray[ix, iy] - y0
+            r2 = dx * dx + dy * dy
+            e = np.exp(r2 / (-2.0 * sigma * sigma))
+
+            J[i, off_x] += level * dx * e / sigma**2
+            J[i, off_y] += level * dy * e / sigma**2
+            J[i, off_sig] += level * r2 * e / sigma**3
+            J[i, off_int] += e
+
+    @nb.njit(parallel=True, fastmath=True, cache=True)
+    def _gauss_ring_func(DP, xArray, yArray, x0, y0, radius, sigma, level):
+        """
+        Add a GaussianRing to DP in a single pass over the pattern.
+        """
+        Q_Ny = DP.shape[1]
+        for i in nb.prange(DP.shape[0] * Q_Ny):
+            ix = i // Q_Ny
+            iy = i - ix * Q_Ny
+            dx = xArray[ix, iy] - x0
+            dy = yArray[ix, iy] - y0
+            local_r = radius - np.sqrt(dx * dx + dy * dy)
+            DP[ix, iy] += level * np.exp(local_r * local_r / (-2.0 * sigma * sigma))
+
+    @nb.njit(parallel=True, fastmath=True, cache=True)
+    def _gauss_ring_jac(
+        J,
+        xArray,
+        yArray,
+        x0,
+        y0,
+        radius,
+        sigma,
+        level,
+        off_x,
+        off_y,
+        off_radius,
+        off_sigma,
+        off_int,
+    ):
+        """
+        Accumulate the five partial derivatives of a GaussianRing into J
+        in a single pass over the pattern.
+        """
+        Q_Ny = xArray.shape[1]
+        for i in nb.prange(xArray.shape[0] * Q_Ny):
+            ix = i // Q_Ny
+            iy = i - ix * Q_Ny
+            dx = xArray[ix, iy] - x0
+            dy = yArray[ix, iy] - y0
+            r = np.sqrt(dx * dx + dy * dy)
+            local_r = radius - r
+            clipped_r = max(r, 0.1)
+            e = np.exp(local_r * local_r / (-2.0 * sigma * sigma))
+
+            J[i, off_x] -= level * e * dx * local_r / (sigma**2 * clipped_r)
+            J[i, off_y] -= level * e * dy * local_r / (sigma**2 * clipped_r)
+            J[i, off_radius] -= level * e * local_r / sigma**2
+            J[i, off_sigma] += level * local_r * local_r * e / sigma**3
+            J[i, off_int] += e
+
+    @nb.njit(parallel=True, fastmath=True, cache=True)
+    def _disk_lattice_func(
+        DP,
+        xArray,
+        yArray,
+        x0,
+        y0,
+        ux,
+        uy,
+        vx,
+        vy,
+        u_inds,
+        v_inds,
+        intensities,
+        disk_radius,
+        disk_width,
+    ):
+        """
+        Accumulate the soft-edged disks of a SyntheticDiskLattice into DP.
+
+        The logistic edge is below 1e-8 beyond 5 edge widths outside the disk
+        radius, so only the pixels inside that bounding box of each disk are
+        visited. The pattern is split into square tiles that are processed in
+        parallel, each one adding every disk whose bounding box overlaps it,
+        so a tile stays in cache while all of its disks are accumulated.
+        xArray and yArray are the pixel-index meshgrid.
+        """
+        Q_Nx, Q_Ny = DP.shape
+        cutoff = disk_radius + 5.0 * disk_width
+        n_peaks = u_inds.shape[0]
+
+        # bounding box of each disk, clipped to the pattern
+        x_pos = np.empty(n_peaks)
+        y_pos = np.empty(n_peaks)
+        bbox = np.empty((n_peaks, 4), dtype=np.int64)
+        for k in range(n_peaks):
+            x_pos[k] = x0 + (u_inds[k] * ux) + (v_inds[k] * vx)
+            y_pos[k] = y0 + (u_inds[k] * uy) + (v_inds[k] * vy)
+            bbox[k, 0] = max(int(np.floor(x_pos[k] - cutoff)), 0)
+            bbox[k, 1] = min(int(np.ceil(x_pos[k] + cutoff)) + 1, Q_Nx)
+            bbox[k, 2] = max(int(np.floor(y_pos[k] - cutoff)), 0)
+            bbox[k, 3] = min(int(np.ceil(y_pos[k] + cutoff)) + 1, Q_Ny)
+
+        n_tiles_y = (Q_Ny + _TILE_SIZE - 1) // _TILE_SIZE
+        n_tiles = ((Q_Nx + _TILE_SIZE - 1) // _TILE_SIZE) * n_tiles_y
+        for t in nb.prange(n_tiles):
+            tx0 = (t // n_tiles_y) * _TILE_SIZE
+            ty0 = (t % n_tiles_y) * _TILE_SIZE
+            tx1 = min(tx0 + _TILE_SIZE, Q_Nx)
+            ty1 = min(ty0 + _TILE_SIZE, Q_Ny)
+
+            for k in range(n_peaks):
+                ix0 = max(bbox[k, 0], tx0)
+                ix1 = min(bbox[k, 1], tx1)
+                iy0 = max(bbox[k, 2], ty0)
+                iy1 = min(bbox[k, 3], ty1)
+                if ix0 >= ix1 or iy0 >= iy1:
+                    continue
+
+                for ix in range(ix0, ix1):
+                    for iy in range(iy0, iy1):
+                        dx = xArray[ix, iy] - x_pos[k]
+                        dy = yArray[ix, iy] - y_pos[k]
+                        r_disk = np.sqrt(dx * dx + dy * dy)
+                        if r_disk >= cutoff:
+                            continue
+                        DP[ix, iy] += intensities[k] / (
+                            1.0 + np.exp(4.0 * (r_disk - disk_radius) / disk_width)
+                        )
+
+    @functools.lru_cache(maxsize=None)
+    def _disk_lattice_jac_kernel(refine_radius, refine_width):
+        """
+        Return the SyntheticDiskLattice Jacobian kernel specialized to one
+        combination of the refine_radius and refine_width flags. The flags are
+        compile-time constants of the kernel, so the derivatives of disk
+        parameters that are not refined are compiled out.
+        """
+
+        @nb.njit(parallel=True, fastmath=True, cache=True)
+        def _disk_lattice_jac(
+            J,
+            xArray,
+            yArray,
+            x0,
+            y0,
+            ux,
+            uy,
+            vx,
+            vy,
+            u_inds,
+            v_inds,
+            intensities,
+            disk_radius,
+            disk_width,
+            center_offsets,
+            lattice_offsets,
+            intensity_offsets,
+            radius_offset,
+            width_offset,
+        ):
+            """
+            Accumulate the Jacobian of a SyntheticDiskLattice into J.
+
+            Each disk is cut off at the same radius as in _disk_lattice_func,
+            and only the pixels inside its bounding box are visited. As in
+            _disk_lattice_func, the pattern is split into square tiles that are
+            processed in parallel, each one adding every disk whose bounding box
+            overlaps it, so every tile writes to its own rows of J.
+            xArray and yArray are the pixel-index meshgrid, so that the row of J
+            belonging to pixel (ix, iy) is ix * Q_Ny + iy.
+            radius_offset and width_offset are only used when those are refined.
+            """
+            Q_Nx, Q_Ny = xArray.shape
+            cutoff = disk_radius + 5.0 * disk_width
+            n_peaks = u_inds.shape[0]
+
+            # bounding box of each disk, clipped to the pattern
+            x_pos = np.empty(n_peaks)
+            y_pos = np.empty(n_peaks)
+            bbox = np.empty((n_peaks, 4), dtype=np.int64)
+            for k in range(n_peaks):
+                x_pos[k] = x0 + (u_inds[k] * ux) + (v_inds[k] * vx)
+                y_pos[k] = y0 + (u_inds[k] * uy) + (v_inds[k] * vy)
+                bbox[k, 0] = max(int(np.floor(x_pos[k] - cutoff)), 0)
+                bbox[k, 1] = min(int(np.ceil(x_pos[k] + cutoff)) + 1, Q_Nx)
+                bbox[k, 2] = max(int(np.floor(y_pos[k] - cutoff)), 0)
+                bbox[k, 3] = min(int(np.ceil(y_pos[k] + cutoff)) + 1, Q_Ny)
+
+            n_tiles_y = (Q_Ny + _TILE_SIZE - 1) // _TILE_SIZE
+            n_tiles = ((Q_Nx + _TILE_SIZE - 1) // _TILE_SIZE) * n_tiles_y
+            for t in nb.prange(n_tiles):
+                tx0 = (t // n_tiles_y) * _TILE_SIZE
+                ty0 = (t % n_tiles_y) * _TILE_SIZE
+                tx1 = min(tx0 + _TILE_SIZE, Q_Nx)
+                ty1 = min(ty0 + _TILE_SIZE, Q_Ny)
+
+                for k in range(n_peaks):
+                    ix0 = max(bbox[k, 0], tx0)
+                    ix1 = min(bbox[k, 1], tx1)
+                    iy0 = max(bbox[k, 2], ty0)
+                    iy1 = min(bbox[k, 3], ty1)
+                    if ix0 >= ix1 or iy0 >= iy1:
+                        continue
+
+                    u = u_inds[k]
+                    v = v_inds[k]
+                    disk_intensity = intensities[k]
+
+                    for ix in range(ix0, ix1):
+                        for iy in range(iy0, iy1):
+                            xa = xArray[ix, iy]
+                            ya = yArray[ix, iy]
+
+                            r_disk = np.sqrt(
+                                (xa - x_pos[k]) ** 2 + (ya - y_pos[k]) ** 2
+                            )
+                            if r_disk >= cutoff:
+                                continue
+
+                            top_exp = np.exp(
+                                min(30.0, 4.0 * (r_disk - disk_radius) / disk_width)
+                            )
+                            denom = (1.0 + top_exp) ** 2
+
+                            # dF/d(x0) and dF/d(y0)
+                            d_r = (
+                                4.0
+                                * disk_intensity
+                                * top_exp
+                                / (denom * disk_width * max(1e-6, r_disk))
+                            )
+                            dx = (xa - x_pos[k]) * d_r
+                            dy = (ya - y_pos[k]) * d_r
+
+                            row = ix * Q_Ny + iy
+
+                            # center position derivatives
+                            J[row, center_offsets[0]] += dx
+                            J[row, center_offsets[1]] += dy
+
+                            # lattice vector derivatives
+                            J[row, lattice_offsets[0]] += u * dx
+                            J[row, lattice_offsets[1]] += u * dy
+                            J[row, lattice_offsets[2]] += v * dx
+                            J[row, lattice_offsets[3]] += v * dy
+
+                            # intensity derivative
+                            J[row, intensity_offsets[k]] += 1.0 / (1.0 + top_exp)
+
+                            if refine_radius:
+                                J[row, radius_offset] += (
+                                    4.0
+                                    * disk_intensity
+                                    * top_exp
+                                    / (disk_width * denom)
+                                )
+
+                            if refine_width:
+                                J[row, width_offset] += (
+                                    4.0
+                                    * disk_intensity
+                                    * top_exp
+                                    * (r_disk - disk_radius)
+                                    / (disk_width**2 * denom)
+                                )
+
+        return _disk_lattice_jac
@@ -1,16 +1,21 @@
 from __future__ import annotations
 from py4DSTEM import DataCube, RealSlice
 from emdfile import tqdmnd
+from tqdm import tqdm
+from py4DSTEM.process.wholepatternfit import wp_models
 from py4DSTEM.process.wholepatternfit.wp_models import (
     WPFModel,
     _BaseModel,
     WPFModelType,
     Parameter,
+    _distance,
+    _JacobianColumns,
 )
 from py4DSTEM.data import RealSlice
 from py4DSTEM.process.strain.latticevectors import get_strain_from_reference_g1g2
 
 from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 from scipy.optimize import least_squares
@@ -18,9 +23,34 @@ import matplotlib.pyplot as plt
 import matplotlib.colors as mpl_c
 from matplotlib.gridspec import GridSpec
 
+try:
+    import cupy as cp
+except (ImportError, ModuleNotFoundError):
+    cp = None
+
 __all__ = ["WholePatternFit"]
 
 
+class PatternScratch:
+    """
+    Scratch space shared by all models during a single evaluation of the
+    pattern or its Jacobian. It only lives for that one evaluation, so
+    cached results can be keyed by parameter offsets rather than values.
+
+    shift_cache: dict mapping the (x, y) offsets of a center to the coordinate
+        grids shifted to it
+    r_cache: dict mapping the (x, y) offsets of a center to its distance map
+    """
+
+    def __init__(self):
+        self.shift_cache = {}
+        self.r_cache = {}
+
+
+def _start_worker_probe():
+    """Target of the process _distributed_start_method starts as a check"""
+
+
 class WholePatternFit:
     from py4DSTEM.process.wholepatternfit.wpf_viz import (
         show_model_grid,
@@ -36,6 +66,8 @@ class WholePatternFit:
         mask: Optional[np.ndarray] = None,
         use_jacobian: bool = True,
         meanCBED: Optional[np.ndarray] = None,
+        num_threads: int = 1,
+        device: str = "cpu",
     ):
         """
         Perform pixelwise fits using composable models and numerical optimization.
@@ -71,8 +103,25 @@ class WholePatternFit:
         meanCBED: Optional np.ndarray, used to specify the diffraction pattern used
             for initial refinement of the parameters. If not specified, the average across
             all scan positions is computed
+        num_threads: int, number of threads used to evaluate the models
+            concurrently within each evaluation of the pattern or Jacobian. Each thread
+            sums its share of the models into a private buffer holding only the
+            columns of the Jacobian they touch, and the buffers are added together
+            afterwards. The Numba kernels are already parallel and are not safe to
+            launch from several threads, so with Numba installed and device='cpu'
+            the models using them are all evaluated by one thread, and only the
+            remaining models are shared among the others
+        device: str, 'cpu' or 'gpu' to select where the model patterns and Jacobians
+            are computed. On the GPU the models run on CuPy arrays and the results are
+            copied back to the host for the optimizer once per evaluation
 
         """
+        if device not in ("cpu", "gpu"):
+            raise ValueError(f"device must be either 'cpu' or 'gpu', not {device}")
+        if device == "gpu" and cp is None:
+            raise ImportError("device='gpu' requires cupy to be installed")
+        self.device = device
+
         self.datacube = datacube
         self.meanCBED = (
             meanCBED if meanCBED is not None else np.mean(datacube.data, axis=(0, 1))
@@ -80,7 +129,9 @@ class WholePatternFit:
         # Global scaling parameter
         self.intensity_scale = 1 / np.mean(self.meanCBED)
 
-        self.mask = mask if mask is not None else np.ones_like(self.meanCBED)
+        self.mask = (
+            mask if mask is not None else np.ones(self.meanCBED.shape, dtype=bool)
+        )
 
         if hasattr(x0, "__iter__") and hasattr(y0, "__iter__"):
             x0 = np.array(x0)
@@ -114,6 +165,14 @@ class WholePatternFit:
         self.nParams = 0
         self.use_jacobian = use_jacobian
 
+        if not isinstance(num_threads, int) or num_threads < 1:
+            raise ValueError(
+                f"num_threads must be a positive integer, not {num_threads}"
+            )
+        self.num_threads = num_threads
+        # created on first use, since it cannot be pickled
+        self._executor = None
+
         # set up the global arguments
         self._setup_static_data()
 
@@ -208,6 +267,14 @@ class WholePatternFit:
         self._finalize_model()
         return self._pattern(self.x0, self.static_data.copy()) / self.intensity_scale
 
+    @property
+    def _xp(self):
+        # not stored as an attribute, since modules cannot be pickled
+        return cp if self.device == "gpu" else np
+
+    def _asnumpy(self, array):
+        return cp.asnumpy(array) if self.device == "gpu" else array
+
     def fit_to_mean_CBED(self, **fit_opts):
         """
         Fit model parameters to the mean CBED pattern
@@ -237,6 +304,8 @@ class WholePatternFit:
             "method": "trf",
             "verbose": 1,
             "x_scale": "jac",
+            # finite differences need a step resolvable in single precision
+            "diff_step": np.sqrt(np.finfo(np.float32).eps),
         }
         default_opts.update(fit_opts)
 
@@ -320,7 +389,10 @@ class WholePatternFit:
             Only perform the fitting on a subset of the probe positions,
             where real_space_mask[rx,ry] == True.
         distributed: bool (optional)
-            Whether to evaluate using a pool of worker threads
+            Whether to evaluate using a pool of worker processes. When the
+            Numba kernels use the OpenMP or TBB threading layer, the workers
+            re-import the calling script, which then has to guard its top-level
+            code with ``if __name__ == "__main__":``
         num_jobs: int (optional)
             number of parallel worker threads to launch if distributed=True
             Defaults to number of CPU cores
@@ -359,6 +431,8 @@ class WholePatternFit:
             "method": "trf",
             "verbose": 0,
             "x_scale": "jac",
+            # finite differences need a step resolvable in single precision
+            "diff_step": np.sqrt(np.finfo(np.float32).eps),
         }
         default_opts.update(fit_opts)
 
@@ -552,7 +626,13 @@ class WholePatternFit:
         """
         self.static_data = {}
 
-        xArray, yArray = np.mgrid[0 : self.datacube.Q_Nx, 0 : self.datacube.Q_Ny]
+        # the pattern arithmetic of all models is done in single precision
+        xArray, yArray = self._xp.mgrid[
+            0 : self.datacube.Q_Nx, 0 : self.datacube.Q_Ny
+        ].astype(np.float32)
+        # the models rely on temporaries built from these being C-contiguous,
+        # so that ravel() into the columns of J is a view rather than a copy
+        assert xArray.flags.c_contiguous and yArray.flags.c_contiguous
         self.static_data["xArray"] = xArray
         self.static_data["yArray"] = yArray
 
@@ -561,20 +641,53 @@ class WholePatternFit:
 
         self.static_data["parent"] = self
 
-    def _get_distance(self, params: np.ndarray, x: Parameter, y: Parameter):
+    def _get_distance(
+        self,
+        params: np.ndarray,
+        x: Parameter,
+        y: Parameter,
+        scratch: Optional[PatternScratch] = None,
+    ):
         """
         Return the distance from a point in pixel coordinates specified
         by two Parameter objects.
-        This method caches the result from the _BaseModel for performance
+        When a PatternScratch is given, the result is cached in it so that
+        models sharing a center compute the distance only once per evaluation.
+        The returned array must not be modified in place.
         """
-        if (
-            x is self.model[0].params["x center"]
-            and y is self.model[0].params["y center"]
-        ):
-            # TODO: actually implement caching
-            pass
-
-        return np.hypot(
+        if scratch is not None:
+            key = (x.offset, y.offset)
+            r = scratch.r_cache.get(key)
+            if r is None:
+                r = scratch.r_cache[key] = _distance(
+                    self._xp, *self._get_shifted_grids(params, x, y, scratch)
+                )
+            return r
+
+        return _distance(self._xp, *self._get_shifted_grids(params, x, y))
+
+    def _get_shifted_grids(
+        self,
+        params: np.ndarray,
+        x: Parameter,
+        y: Parameter,
+        scratch: Optional[PatternScratch] = None,
+    ):
+        """
+        Return (xArray - x0, yArray - y0) for the point in pixel coordinates
+        specified by two Parameter objects.
+        When a PatternScratch is given, the result is cached in it so that
+        models sharing a center shift the grids only once per evaluation.
+        The returned arrays must not be modified in place.
+        """
+        if scratch is not None:
+            key = (x.offset, y.offset)
+            grids = scratch.shift_cache.get(key)
+            if grids is None:
+                grids = scratch.shift_cache[key] = self._get_shifted_grids(params, x, y)
+            return grids
+
+        return (
             self.static_data["xArray"] - params[x.offset],
             self.static_data["yArray"] - params[y.offset],
         )
@@ -592,22 +705,89 @@ class WholePatternFit:
         return DP.ravel()
 
     def _pattern(self, x, shared_data):
-        DP = np.zeros((self.datacube.Q_Nx, self.datacube.Q_Ny))
+        x = x.astype(shared_data["xArray"].dtype)
+        # shape from shared_data, since pickled copies in worker processes
+        # do not carry the datacube
+        DP = self._xp.zeros((shared_data["Q_Nx"], shared_data["Q_Ny"]), dtype=x.dtype)
 
-        for m in self.model:
-            m.func(DP, x, **shared_data)
+        self._accumulate_models("func", DP, x, shared_data)
 
-        return DP * self.mask
+        DP = self._asnumpy(DP)
+        DP *= self.mask
+        return DP
 
     def _jacobian(self, x, current_pattern, shared_data):
         # TODO: automatic mixed analytic/finite difference
 
-        J = np.zeros(((self.datacube.Q_Nx * self.datacube.Q_Ny), self.nParams))
+        x = x.astype(shared_data["xArray"].dtype)
+        J = self._xp.zeros(
+            ((shared_data["Q_Nx"] * shared_data["Q_Ny"]), self.nParams), dtype=x.dtype
+        )
 
-        for m in self.model:
-            m.jacobian(J, x, **shared_data)
+        self._accumulate_models("jacobian", J, x, shared_data)
+
+        J = self._asnumpy(J)
+        J *= self.mask.ravel()[:, np.newaxis]
+        return J
 
-        return J * self.mask.ravel()[:, np.newaxis]
+    def _accumulate_models(self, method, out, x, shared_data):
+        """
+        Sum the contribution of every model into out, by calling
+        model.func or model.jacobian (given by method) for each of them.
+
+        With several threads the models are dealt round-robin into one group
+        per thread and each group is summed into its own buffer (the first
+        group directly into out), so no array is ever written by two threads,
+        even when models share parameters and hence Jacobian columns. For the
+        Jacobian, the buffers only hold the columns their models write to, and
+        are scatter-added into those columns of out. Models running Numba
+        kernels are not dealt out but all kept in the first group.
+        """
+        scratch = PatternScratch()
+
+        # the prange kernels must not be launched from several threads at once,
+        # so the models running them all go into the first group
+        if wp_models.nb is not None and self.device == "cpu":
+            serial = [m for m in self.model if m._uses_numba]
+        else:
+            serial = []
+        pooled = [m for m in self.model if m not in serial]
+        n_groups = min(self.num_threads, len(pooled) + bool(serial))
+
+        if n_groups == 1:
+            for m in self.model:
+                getattr(m, method)(out, x, scratch=scratch, **shared_data)
+            return
+
+        if serial:
+            groups = [serial] + [pooled[i :: n_groups - 1] for i in range(n_groups - 1)]
+        else:
+            groups = [pooled[i::n_groups] for i in range(n_groups)]
+
+        def accumulate(group, buffer):
+            for m in group:
+                getattr(m, method)(buffer, x, scratch=scratch, **shared_data)
+            return buffer
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+
+        buffers = [out]
+        for group in groups[1:]:
+            if method == "jacobian":
+                columns = np.unique(
+                    np.concatenate([m._jacobian_offsets for m in group])
+                )
+                buffer = self._xp.zeros((out.shape[0], columns.size), dtype=out.dtype)
+                buffers.append(_JacobianColumns(buffer, columns))
+            else:
+                buffers.append(self._xp.zeros_like(out))
+
+        for buffer in self._executor.map(accumulate, groups, buffers):
+            if isinstance(buffer, _JacobianColumns):
+                out[:, buffer.columns] += buffer.array
+            elif buffer is not out:
+                out += buffer
 
     def _finalize_model(self):
         # iterate over all models and assign indices, accumulate list
@@ -635,6 +815,9 @@ class WholePatternFit:
                     param.offset = idx
                     idx += 1
 
+        for model in self.model:
+            model.finalize_offsets()
+
         self.x0 = np.array([param.initial_value for param in unique_params])
         self.upper_bound = np.array([param.upper_bound for param in unique_params])
         self.lower_bound = np.array([param.lower_bound for param in unique_params])
@@ -723,15 +906,13 @@ class WholePatternFit:
         """
         Run fitting using multiprocessing to fit several patterns in parallel
         """
+        from functools import partial
         from mpire import WorkerPool, cpu_count
-        from threadpoolctl import threadpool_limits
 
         # prevent oversubscription when using multiple threads per job
         num_jobs = num_jobs or cpu_count() // threads_per_job
 
-        def f(shared_data, args):
-            with threadpool_limits(limits=threads_per_job):
-                return self._fit_single_pattern(**args, fit_opts=shared_data)
+        f = partial(self._fit_pattern_in_worker, threads_per_job)
 
         # hopefully the data entries remain as views until dispatch time...
         fit_inputs = [
@@ -746,14 +927,20 @@ class WholePatternFit:
             for ry in range(self.datacube.R_Ny)
         ]
 
+        start_method = self._distributed_start_method()
+
+        # The progress bar is drawn here rather than by mpire, whose progress
+        # bar manager process is always forked.
         with WorkerPool(
             n_jobs=num_jobs,
             shared_objects=fit_opts,
+            start_method=start_method,
         ) as pool:
-            results = pool.map(
-                f,
-                fit_inputs,
-                progress_bar=True,
+            results = list(
+                tqdm(
+                    pool.imap(f, fit_inputs, iterable_len=len(fit_inputs)),
+                    total=len(fit_inputs),
+                )
             )
 
         for (rx, ry), res in zip(
@@ -762,6 +949,60 @@ class WholePatternFit:
             fit_data[:, rx, ry] = res[0]
             fit_metrics[:, rx, ry] = res[1]
 
+    @staticmethod
+    def _distributed_start_method() -> str:
+        """
+        Choose how _fit_distributed starts its worker processes.
+
+        Forking a process that has already run the Numba kernels is unsafe
+        with the OpenMP and TBB threading layers, so workers are then started
+        from a fresh interpreter instead, receiving this object pickled
+        (without datacube). That interpreter re-imports the calling script,
+        which must therefore guard its top-level code with
+        ``if __name__ == "__main__":``. This is checked up front with a single
+        throwaway process, as the pool would otherwise wait forever on
+        workers that failed to start.
+        """
+        import multiprocessing
+
+        try:
+            layer = wp_models.nb.threading_layer() if wp_models.nb else None
+        except ValueError:
+            # no parallel kernel has run in this process yet
+            layer = None
+        if layer not in ("omp", "tbb"):
+            return "fork"
+
+        probe = multiprocessing.get_context("forkserver").Process(
+            target=_start_worker_probe
+        )
+        probe.start()
+        probe.join()
+        if probe.exitcode != 0:
+            raise RuntimeError(
+                f"Distributed fitting with the Numba {layer} threading layer "
+                "starts its workers from a fresh interpreter, which failed to "
+                "start. Make sure the calling script guards its top-level code "
+                'with if __name__ == "__main__":, or use distributed=False.'
+            )
+        return "forkserver"
+
+    def _fit_pattern_in_worker(self, threads_per_job, fit_opts, args):
+        """
+        Fit one pattern inside a worker of _fit_distributed, with the BLAS
+        and Numba thread pools limited to threads_per_job threads
+        """
+        from threadpoolctl import threadpool_limits
+
+        # threadpoolctl does not manage the Numba thread pool
+        if wp_models.nb is not None:
+            wp_models.nb.set_num_threads(
+                min(threads_per_job, wp_models.nb.config.NUMBA_NUM_THREADS)
+            )
+
+        with threadpool_limits(limits=threads_per_job):
+            return self._fit_single_pattern(**args, fit_opts=fit_opts)
+
     def __getstate__(self):
         # Prevent pickling from copying the datacube, so that distributed
         # evaluation does not balloon memory usage.
@@ -771,4 +1012,5 @@ class WholePatternFit:
         state = self.__dict__.copy()
         # Remove the unpicklable entries.
         del state["datacube"]
+        state["_executor"] = None
         return state
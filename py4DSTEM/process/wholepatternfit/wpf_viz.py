@@ -22,8 +22,9 @@ def show_model_grid(self, x=None, **plot_kwargs):
     fig, ax = plt.subplots(rows, cols, **kwargs)
 
     for a, m in zip(ax.flat, model):
-        DP = np.zeros((self.datacube.Q_Nx, self.datacube.Q_Ny))
-        m.func(DP, x, **self.static_data)
+        DP = self._xp.zeros((self.datacube.Q_Nx, self.datacube.Q_Ny), dtype=np.float32)
+        m.func(DP, x.astype(np.float32), **self.static_data)
+        DP = self._asnumpy(DP)
 
         a.matshow(DP, cmap="turbo")
 
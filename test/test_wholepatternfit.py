@@ -0,0 +1,166 @@
+import py4DSTEM
+import numpy as np
+import pytest
+
+from py4DSTEM.process.wholepatternfit import wp_models
+
+# ux, uy, vx, vy, disk_radius, disk_width, u_max, v_max, intensity_0
+_LATTICE = (11.3, 1.2, -0.9, 12.1, 3.5, 1.2, 2, 2, 1.5)
+# disks whose soft edge reaches well beyond twice their radius
+_WIDE_EDGE_LATTICE = (11.3, 1.2, -0.9, 12.1, 2.0, 1.0, 2, 2, 1.5)
+
+
+def _fit(make_model):
+    """a small WholePatternFit with a single model, centered off the pixel grid"""
+    datacube = py4DSTEM.DataCube(data=np.zeros((2, 2, 48, 48)))
+    wpf = py4DSTEM.process.wholepatternfit.WholePatternFit(datacube, x0=23.3, y0=24.6)
+    wpf.add_model(make_model(wpf))
+    return wpf
+
+
+@pytest.mark.parametrize(
+    "make_model",
+    [
+        lambda wpf: wp_models.GaussianRing(wpf, 12.0, 2.5, 2.0),
+        lambda wpf: wp_models.SyntheticDiskLattice(wpf, *_LATTICE),
+        lambda wpf: wp_models.SyntheticDiskLattice(
+            wpf, *_LATTICE, refine_radius=True, refine_width=True
+        ),
+        lambda wpf: wp_models.SyntheticDiskLattice(
+            wpf, *_WIDE_EDGE_LATTICE, refine_radius=True, refine_width=True
+        ),
+    ],
+    ids=["GaussianRing", "DiskLattice", "DiskLatticeRefine", "DiskLatticeWideEdge"],
+)
+@pytest.mark.parametrize("use_numba", [True, False], ids=["numba", "numpy"])
+def test_wpf_jacobian_finite_difference(make_model, use_numba, monkeypatch):
+    """tests the analytic Jacobian of a WPF against central finite differences"""
+    if use_numba and wp_models.nb is None:
+        pytest.skip("numba is not installed")
+    if not use_numba:
+        monkeypatch.setattr(wp_models, "nb", None)
+
+    wpf = _fit(make_model)
+    x = wpf.x0.astype(np.float64)
+
+    J = wpf._jacobian(x, None, wpf.static_data)
+
+    h = 1e-2
+    J_fd = np.stack(
+        [
+            (
+                wpf._pattern(x + dx, wpf.static_data)
+                - wpf._pattern(x - dx, wpf.static_data)
+            ).ravel()
+            / (2 * h)
+            for dx in np.eye(x.size) * h
+        ],
+        axis=1,
+    )
+
+    assert J.shape == (48 * 48, wpf.nParams)
+    assert np.abs(J - J_fd).max() < 1e-3 * np.abs(J_fd).max()
+
+
+@pytest.mark.parametrize(
+    "make_model",
+    [
+        lambda wpf: wp_models.GaussianBackground(wpf, sigma=9.0, intensity=2.0),
+        lambda wpf: wp_models.GaussianRing(wpf, 12.0, 2.5, 2.0),
+        lambda wpf: wp_models.SyntheticDiskLattice(wpf, *_LATTICE),
+        lambda wpf: wp_models.SyntheticDiskLattice(
+            wpf, *_LATTICE, refine_radius=True, refine_width=True
+        ),
+    ],
+    ids=["GaussianBackground", "GaussianRing", "DiskLattice", "DiskLatticeRefine"],
+)
+def test_wpf_numba_matches_numpy(make_model, monkeypatch):
+    """tests that the Numba kernels agree with the NumPy fallback"""
+    if wp_models.nb is None:
+        pytest.skip("numba is not installed")
+
+    wpf = _fit(make_model)
+    x = wpf.x0 + np.random.default_rng(0).normal(scale=0.05, size=wpf.x0.shape)
+
+    DP_nb = wpf._pattern(x, wpf.static_data)
+    J_nb = wpf._jacobian(x, None, wpf.static_data)
+
+    monkeypatch.setattr(wp_models, "nb", None)
+    DP_np = wpf._pattern(x, wpf.static_data)
+    J_np = wpf._jacobian(x, None, wpf.static_data)
+
+    # both run in float32, with fastmath in the kernels
+    assert np.abs(DP_nb - DP_np).max() < 1e-4 * np.abs(DP_np).max()
+    assert np.abs(J_nb - J_np).max() < 1e-4 * np.abs(J_np).max()
+
+
+def _moire_models(wpf):
+    """two lattices with their moire, plus backgrounds, for a WholePatternFit"""
+    refine = {"refine_radius": True, "refine_width": True}
+    lattice_a = wp_models.SyntheticDiskLattice(
+        wpf, 10.3, 1.2, -0.9, 11.1, 2.5, 1.0, 1, 1, 1.5, **refine
+    )
+    lattice_b = wp_models.SyntheticDiskLattice(
+        wpf, 11.5, 0.4, -0.2, 12.0, 2.5, 1.0, 1, 1, 1.5, **refine
+    )
+    return [
+        wp_models.DCBackground(0.1),
+        wp_models.GaussianBackground(wpf, sigma=9.0, intensity=2.0),
+        lattice_a,
+        lattice_b,
+        wp_models.SyntheticDiskMoire(wpf, lattice_a, lattice_b, 0.5),
+    ]
+
+
+@pytest.mark.parametrize("use_numba", [True, False], ids=["numba", "numpy"])
+def test_wpf_threads_match_serial(use_numba, monkeypatch):
+    """tests that evaluating the models on several threads matches one thread"""
+    if use_numba and wp_models.nb is None:
+        pytest.skip("numba is not installed")
+    if not use_numba:
+        monkeypatch.setattr(wp_models, "nb", None)
+
+    datacube = py4DSTEM.DataCube(data=np.zeros((2, 2, 48, 48)))
+    results = []
+    for num_threads in (1, 3):
+        wpf = py4DSTEM.process.wholepatternfit.WholePatternFit(
+            datacube, x0=23.3, y0=24.6, num_threads=num_threads
+        )
+        wpf.add_model_list(_moire_models(wpf))
+        x = wpf.x0 + np.random.default_rng(0).normal(scale=0.05, size=wpf.x0.shape)
+        results.append(
+            (
+                wpf._pattern(x, wpf.static_data),
+                wpf._jacobian(x, None, wpf.static_data),
+            )
+        )
+
+    (DP_1, J_1), (DP_3, J_3) = results
+    assert np.abs(DP_3 - DP_1).max() < 1e-5 * np.abs(DP_1).max()
+    assert np.abs(J_3 - J_1).max() < 1e-5 * np.abs(J_1).max()
+
+
+def test_wpf_gpu_matches_cpu():
+    """tests that evaluating the models with CuPy matches the CPU"""
+    pytest.importorskip("cupy")
+
+    datacube = py4DSTEM.DataCube(data=np.zeros((2, 2, 48, 48)))
+    results = []
+    for device in ("cpu", "gpu"):
+        wpf = py4DSTEM.process.wholepatternfit.WholePatternFit(
+            datacube, x0=23.3, y0=24.6, device=device
+        )
+        wpf.add_model_list(
+            _moire_models(wpf) + [wp_models.GaussianRing(wpf, 12.0, 2.5, 2.0)]
+        )
+        x = wpf.x0 + np.random.default_rng(0).normal(scale=0.05, size=wpf.x0.shape)
+        results.append(
+            (
+                wpf._pattern(x, wpf.static_data),
+                wpf._jacobian(x, None, wpf.static_data),
+            )
+        )
+
+    (DP_cpu, J_cpu), (DP_gpu, J_gpu) = results
+    assert np.abs(DP_gpu - DP_cpu).max() < 1e-4 * np.abs(DP_cpu).max()
+    assert np.abs(J_gpu - J_cpu).max() < 1e-4 * np.abs(J_cpu).max()